@@ -7,27 +7,52 @@ using LoRA (Low-Rank Adaptation) via Unsloth for 4x faster training.
 
 Requirements:
     pip install unsloth transformers datasets peft trl
+    pip install flash-attn --no-build-isolation  # Optional: Unsloth uses it on Ampere+
+    pip install orjson  # Optional: faster JSONL parsing
 
 Usage:
     # On Google Colab (free T4 GPU):
     python fine-tune.py
 
-    # Or locally with CUDA:
+    # Or locally (CUDA uses Unsloth; Apple Silicon falls back to PEFT on MPS):
     python fine-tune.py --local
 
     # Export to GGUF for Ollama:
     python fine-tune.py --export-gguf
 
+    # Merge saved LoRA adapters into the base weights (no training):
+    python fine-tune.py --merge-only [--export-gguf]
+
+    # Stream a corpus too large for memory:
+    python fine-tune.py --stream --max-steps 2000
+
+    # Quantize with a local llama.cpp build instead of in-process:
+    LLAMA_CPP_DIR=~/llama.cpp python fine-tune.py --export-gguf
+
 Output:
     ./goose-model/          # Fine-tuned model
+    ./goose-model-merged/   # Merged 16-bit HF weights (--merge-only)
     ./goose-model.gguf      # Quantized model for Ollama
 """
 
 import argparse
+import gc
+import hashlib
+import itertools
 import json
+import multiprocessing
 import os
+import shutil
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:  # Fall back to stdlib json (slower, same output)
+    orjson = None
+
 # ═══════════════════════════════════════════════════════════════════
 # CONFIGURATION
 # ═══════════════════════════════════════════════════════════════════
@@ -45,15 +70,19 @@ CONFIG = {
     "target_modules": ["q_proj", "k_proj", "v_proj", "o_proj", "gate_proj", "up_proj", "down_proj"],
 
     # Training
-    "batch_size": 2,
-    "gradient_accumulation_steps": 4,
+    "batch_size_candidates": [8, 4, 2],  # Largest that fits is used
+    "effective_batch_size": 16,  # batch_size * gradient_accumulation_steps
     "learning_rate": 2e-4,
     "num_epochs": 3,
-    "warmup_steps": 5,
+    "warmup_ratio": 0.1,  # Fraction of total steps; packed runs are short
+    "weight_decay": 0.01,
     "max_steps": -1,  # -1 = use num_epochs
+    "packing": True,  # Concatenate short examples into full-length rows (not --stream)
 
     # Output
     "output_dir": "./goose-model",
+    "dataset_cache_dir": "./goose-dataset-cache",
+    "merged_output_dir": "./goose-model-merged",
     "gguf_output": "./goose-model.gguf",
 }
 
@@ -72,74 +101,307 @@ RULES:
 3. Required configs: poll-element needs question+options, rsvp-button needs eventName, countdown-timer needs targetDate, chart-display needs chartType
 4. Keep tools simple - 1-4 elements maximum"""
 
+# Phi-3 instruction format, split around the per-example prompt and output
+_PROMPT_PREFIX = f"<|system|>\n{SYSTEM_PROMPT}\n<|end|>\n<|user|>\n"
+_PROMPT_SUFFIX = "\n<|end|>\n<|assistant|>\n"
+_OUTPUT_SUFFIX = "\n<|end|>"
+
+# Written into the dataset cache after a complete save
+_CACHE_FINGERPRINT = "goose-fingerprint.json"
+
 
 # ═══════════════════════════════════════════════════════════════════
 # DATA LOADING
 # ═══════════════════════════════════════════════════════════════════
 
-def load_training_data(data_dir: str) -> list[dict]:
-    """Load training data from JSONL files."""
-    examples = []
+def _parse_file(jsonl_file: Path) -> list[dict]:
+    """Parse a single JSONL shard."""
+    loads = orjson.loads if orjson is not None else json.loads
+    data = jsonl_file.read_bytes()
+    return [loads(line) for line in data.split(b"\n") if line and not line.isspace()]
 
-    # Load all JSONL files
-    data_path = Path(data_dir)
-    for jsonl_file in data_path.glob("*.jsonl"):
-        if "validation" in jsonl_file.name:
-            continue  # Skip validation for training
 
-        with open(jsonl_file, "r") as f:
-            for line in f:
-                if line.strip():
-                    examples.append(json.loads(line))
+def _training_shards(data_dir: str) -> list[Path]:
+    """List training JSONL files, skipping validation splits."""
+    return [
+        p for p in sorted(Path(data_dir).glob("*.jsonl"))
+        if "validation" not in p.name  # Skip validation for training
+    ]
+
+
+def load_training_data(data_dir: str) -> list[dict]:
+    """Load training data from JSONL files."""
+    shards = _training_shards(data_dir)
+
+    # Parse shards in parallel; a single shard isn't worth a process pool.
+    # Spawn rather than fork: CUDA is already initialized by this point.
+    if len(shards) > 1:
+        workers = min(len(shards), os.cpu_count() or 1)
+        mp_context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context) as ex:
+            results = list(ex.map(_parse_file, shards))
+    else:
+        results = [_parse_file(p) for p in shards]
+    examples = list(itertools.chain.from_iterable(results))
 
     print(f"Loaded {len(examples)} training examples")
     return examples
 
 
+def _dump_output(output: dict) -> str:
+    """Serialize a tool composition as compact JSON.
+
+    Always uses stdlib json so the training target is byte-identical whether
+    or not orjson is installed (orjson skips ASCII escapes and formats floats
+    differently).
+    """
+    return json.dumps(output, separators=(",", ":"))
+
+
+def _format_text(prompt: str, output: str) -> str:
+    return _PROMPT_PREFIX + prompt + _PROMPT_SUFFIX + output + _OUTPUT_SUFFIX
+
+
 def format_for_training(example: dict) -> str:
     """Format a training example for Phi-3 instruction format."""
-    prompt = example["prompt"]
-    output = json.dumps(example["output"], separators=(",", ":"))
+    return _format_text(example["prompt"], _dump_output(example["output"]))
+
+
+def _tokenize(batch: dict, tokenizer) -> dict:
+    """Format and tokenize a batch of prompt/output columns."""
+    texts = [_format_text(p, o) for p, o in zip(batch["prompt"], batch["output"])]
+    encoded = tokenizer(
+        texts,
+        truncation=True,
+        max_length=CONFIG["max_seq_length"],
+        padding=False,
+    )
+    # Lengths for group_by_length, so the sampler never re-tokenizes
+    encoded["length"] = [len(ids) for ids in encoded["input_ids"]]
+    return encoded
+
+
+def _pack(batch: dict, eos_token_id: int) -> dict:
+    """Concatenate tokenized examples, EOS-separated, into max_seq_length rows."""
+    block = CONFIG["max_seq_length"]
+    stream = []
+    for ids in batch["input_ids"]:
+        stream.extend(ids)
+        stream.append(eos_token_id)
+
+    input_ids = [stream[i:i + block] for i in range(0, len(stream), block)]
+    return {
+        "input_ids": input_ids,
+        "attention_mask": [[1] * len(ids) for ids in input_ids],
+        "length": [len(ids) for ids in input_ids],
+    }
+
+
+def _cache_fingerprint(data_dir: str, tokenizer) -> dict:
+    """Describe everything the tokenized cache depends on."""
+    template = _PROMPT_PREFIX + _PROMPT_SUFFIX + _OUTPUT_SUFFIX
+    return {
+        "data_dir": str(Path(data_dir).resolve()),
+        "shards": [
+            [p.name, p.stat().st_size, p.stat().st_mtime_ns]
+            for p in _training_shards(data_dir)
+        ],
+        "base_model": CONFIG["base_model"],
+        "tokenizer": [tokenizer.name_or_path, len(tokenizer)],
+        "max_seq_length": CONFIG["max_seq_length"],
+        "packing": CONFIG["packing"],
+        "template_sha256": hashlib.sha256(template.encode()).hexdigest(),
+        "json_backend": "orjson" if orjson is not None else "json",
+    }
+
+
+def build_dataset(data_dir: str, tokenizer):
+    """Format and tokenize training data, reusing the on-disk cache if fresh.
+
+    The tokenized dataset is saved as Arrow so later runs memory-map it
+    instead of re-formatting and re-tokenizing every example. The cache is
+    only reused when its fingerprint matches the current data and settings.
+    """
+    from datasets import Dataset, load_from_disk
+
+    cache_dir = Path(CONFIG["dataset_cache_dir"])
+    fingerprint_file = cache_dir / _CACHE_FINGERPRINT
+    fingerprint = _cache_fingerprint(data_dir, tokenizer)
+    if fingerprint_file.exists() and json.loads(fingerprint_file.read_text()) == fingerprint:
+        print(f"Using tokenized dataset cache: {cache_dir}")
+        return load_from_disk(str(cache_dir))
+
+    examples = load_training_data(data_dir)
+
+    # Split into columns in one pass; Arrow builds each column at once
+    prompts = []
+    outputs = []
+    for ex in examples:
+        prompts.append(ex["prompt"])
+        outputs.append(_dump_output(ex["output"]))
+    dataset = Dataset.from_dict({"prompt": prompts, "output": outputs})
+
+    # Format and tokenize once up front
+    dataset = dataset.map(
+        _tokenize,
+        fn_kwargs={"tokenizer": tokenizer},
+        batched=True,
+        batch_size=1024,
+        num_proc=max(1, (os.cpu_count() or 1) // 2),
+        remove_columns=["prompt", "output"],
+    )
+
+    # Pack short examples into full-length rows so no step is spent on padding
+    if CONFIG["packing"]:
+        dataset = dataset.map(
+            _pack,
+            fn_kwargs={"eos_token_id": tokenizer.eos_token_id},
+            batched=True,
+            batch_size=1024,
+            remove_columns=dataset.column_names,
+        )
 
-    # Phi-3 instruction format
-    return f"""<|system|>
-{SYSTEM_PROMPT}
-<|end|>
-<|user|>
-{prompt}
-<|end|>
-<|assistant|>
-{output}
-<|end|>"""
+    # Fingerprint is written last, so an interrupted save is never reused
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    dataset.save_to_disk(str(cache_dir))
+    fingerprint_file.write_text(json.dumps(fingerprint))
+    print(f"Saved tokenized dataset cache: {cache_dir}")
+    return dataset
+
+
+def _stream_examples(shards: list[Path]):
+    """Yield prompt/output rows one at a time from JSONL shards."""
+    loads = orjson.loads if orjson is not None else json.loads
+    for jsonl_file in shards:
+        with open(jsonl_file, "rb") as f:
+            for line in f:
+                if line.strip():
+                    ex = loads(line)
+                    yield {"prompt": ex["prompt"], "output": _dump_output(ex["output"])}
+
+
+def stream_dataset(data_dir: str, tokenizer):
+    """Stream and tokenize training data lazily for corpora too large for RAM.
+
+    Shards are passed as a list so dataloader workers each read their own files.
+    Features are declared explicitly so the trainer can see the tokenized
+    columns without iterating the stream.
+    """
+    from datasets import Features, IterableDataset, Sequence, Value
+
+    dataset = IterableDataset.from_generator(
+        _stream_examples,
+        gen_kwargs={"shards": _training_shards(data_dir)},
+    )
+    # Shuffles shard order and examples within a buffer, like the map-style
+    # path's random sampler
+    dataset = dataset.shuffle(seed=42, buffer_size=10_000)
+    return dataset.map(
+        _tokenize,
+        fn_kwargs={"tokenizer": tokenizer},
+        batched=True,
+        batch_size=1024,
+        remove_columns=["prompt", "output"],
+        features=Features({
+            "input_ids": Sequence(Value("int32")),
+            "attention_mask": Sequence(Value("int8")),
+            "length": Value("int32"),
+        }),
+    )
 
 
 # ═══════════════════════════════════════════════════════════════════
 # FINE-TUNING
 # ═══════════════════════════════════════════════════════════════════
 
-def fine_tune(args):
-    """Run fine-tuning with Unsloth."""
-    try:
-        from unsloth import FastLanguageModel
-        from datasets import Dataset
-        from trl import SFTTrainer
-        from transformers import TrainingArguments
-    except ImportError:
-        print("Missing dependencies. Install with:")
-        print("  pip install unsloth transformers datasets peft trl")
-        return
+def find_batch_size(model, tokenizer) -> int:
+    """Return the largest candidate batch size that survives a full-length step."""
+    import torch
 
-    print("=" * 60)
-    print("GOOSE SYSTEM - Fine-Tuning")
-    print("=" * 60)
+    candidates = CONFIG["batch_size_candidates"]
+    for batch_size in candidates:
+        try:
+            input_ids = torch.full(
+                (batch_size, CONFIG["max_seq_length"]),
+                tokenizer.eos_token_id,
+                device=model.device,
+            )
+            model(input_ids=input_ids, labels=input_ids).loss.backward()
+            return batch_size
+        except torch.cuda.OutOfMemoryError:
+            print(f"Batch size {batch_size} does not fit, trying smaller...")
+        finally:
+            model.zero_grad(set_to_none=True)
+            torch.cuda.empty_cache()
 
-    # Load model
+    return candidates[-1]
+
+
+def _is_ampere_or_newer() -> bool:
+    """Check for native bf16/TF32 support (compute capability 8.0+).
+
+    torch.cuda.is_bf16_supported() also counts emulated bf16, so it reports
+    True on pre-Ampere GPUs such as the Colab T4.
+    """
+    import torch
+
+    return torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 8
+
+
+def _compile_forward(model):
+    """Compile only the forward so the PEFT wrapper stays intact for saving.
+
+    Uses the default mode: "reduce-overhead" captures a CUDA graph, with its
+    own memory pool, per input shape, and training shapes vary. Compilation
+    happens lazily on the first call; if it fails, log the error and continue
+    in eager mode.
+    """
+    import torch
+
+    eager_forward = model.forward
+    compiled_forward = torch.compile(eager_forward)
+
+    def forward(*args, **kwargs):
+        try:
+            return compiled_forward(*args, **kwargs)
+        except torch._dynamo.exc.TorchDynamoException as e:
+            print(f"torch.compile failed, falling back to eager: {e}")
+            model.forward = eager_forward
+            return eager_forward(*args, **kwargs)
+
+    model.forward = forward
+
+
+def pick_precision() -> dict:
+    """Pick the fastest supported mixed-precision TrainingArguments flags."""
+    import torch
+
+    if _is_ampere_or_newer():
+        # bf16 needs no loss scaling; TrainingArguments rejects tf32 pre-Ampere
+        return {"bf16": True, "tf32": True}
+    if torch.cuda.is_available():
+        return {"fp16": True}
+    if torch.backends.mps.is_available():
+        return {"fp16": True}
+    return {}
+
+
+def _load_unsloth_model():
+    """Load the 4-bit base model with LoRA adapters via Unsloth (CUDA)."""
+    import torch
+    from unsloth import FastLanguageModel
+
+    # Allow TF32 matmuls and let cuDNN pick the fastest kernels
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.benchmark = True
+
+    # Load model (Unsloth picks attention kernels, using flash-attn if installed)
     print(f"\nLoading base model: {CONFIG['base_model']}")
     model, tokenizer = FastLanguageModel.from_pretrained(
         model_name=CONFIG["base_model"],
         max_seq_length=CONFIG["max_seq_length"],
         load_in_4bit=CONFIG["load_in_4bit"],
-        dtype=None,  # Auto-detect
+        dtype=torch.bfloat16 if _is_ampere_or_newer() else torch.float16,
     )
 
     # Add LoRA adapters
@@ -154,6 +416,92 @@ def fine_tune(args):
         use_gradient_checkpointing="unsloth",
         random_state=42,
     )
+    return model, tokenizer
+
+
+def _load_peft_model():
+    """Load the base model with LoRA adapters via transformers + PEFT.
+
+    Fallback for hosts without CUDA, where Unsloth and 4-bit loading are
+    unavailable. Uses fp16 weights on MPS and fp32 on CPU.
+    """
+    import torch
+    from peft import LoraConfig, get_peft_model
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    if torch.backends.mps.is_available():
+        device, dtype = "mps", torch.float16
+    else:
+        device, dtype = "cpu", torch.float32
+
+    # Load model
+    print(f"\nLoading base model on {device}: {CONFIG['base_model']}")
+    model = AutoModelForCausalLM.from_pretrained(
+        CONFIG["base_model"],
+        torch_dtype=dtype,
+    ).to(device)
+    tokenizer = AutoTokenizer.from_pretrained(CONFIG["base_model"], use_fast=True)
+
+    # Add LoRA adapters
+    print("\nAdding LoRA adapters...")
+    model.gradient_checkpointing_enable()
+    model.enable_input_require_grads()
+    model = get_peft_model(
+        model,
+        LoraConfig(
+            r=CONFIG["lora_r"],
+            target_modules=CONFIG["target_modules"],
+            lora_alpha=CONFIG["lora_alpha"],
+            lora_dropout=CONFIG["lora_dropout"],
+            bias="none",
+            task_type="CAUSAL_LM",
+        ),
+    )
+    return model, tokenizer
+
+
+def fine_tune(args):
+    """Run fine-tuning with Unsloth (or plain PEFT without CUDA)."""
+    # Reuse compiled Triton/Inductor kernels across runs. On Colab, export
+    # these to a mounted Drive path so they survive runtime resets.
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", str(Path.home() / ".cache/hive_torch_inductor"))
+    os.environ.setdefault("TRITON_CACHE_DIR", str(Path.home() / ".cache/hive_triton"))
+
+    try:
+        import torch
+    except ImportError:
+        print("Missing dependencies. Install with:")
+        print("  pip install unsloth transformers datasets peft trl")
+        return
+
+    # Unsloth is CUDA-only; other hosts (e.g. Apple Silicon) use plain PEFT
+    use_cuda = torch.cuda.is_available()
+    try:
+        if use_cuda:
+            import unsloth  # noqa: F401  # Must precede trl/transformers/peft to patch them
+        from trl import SFTTrainer
+        from transformers import (
+            AutoTokenizer,
+            DataCollatorForLanguageModeling,
+            TrainingArguments,
+        )
+
+        print("=" * 60)
+        print("GOOSE SYSTEM - Fine-Tuning")
+        print("=" * 60)
+
+        model, tokenizer = _load_unsloth_model() if use_cuda else _load_peft_model()
+    except ImportError:
+        print("Missing dependencies. Install with:")
+        if use_cuda:
+            print("  pip install unsloth transformers datasets peft trl")
+        else:
+            print("  pip install transformers datasets peft trl")
+        return
+
+    # Tokenize with the Rust-backed fast tokenizer
+    if not tokenizer.is_fast:
+        tokenizer = AutoTokenizer.from_pretrained(CONFIG["base_model"], use_fast=True)
 
     # Load training data
     print("\nLoading training data...")
@@ -161,29 +509,59 @@ def fine_tune(args):
         Path(__file__).parent.parent.parent /
         "packages/core/src/hivelab/goose/training/data"
     )
-    examples = load_training_data(data_dir)
-
-    # Format examples
-    formatted = [{"text": format_for_training(ex)} for ex in examples]
-    dataset = Dataset.from_list(formatted)
+    max_steps = args.max_steps or CONFIG["max_steps"]
+    if args.stream:
+        # Iterable datasets have no length, so epochs can't be counted
+        if max_steps <= 0:
+            print("--stream requires --max-steps (or CONFIG['max_steps'] > 0)")
+            return
+        dataset = stream_dataset(data_dir, tokenizer)
+        print(f"Streaming training data for {max_steps} steps")
+    else:
+        # Packing separates examples with EOS, so the tokenizer must define one
+        if CONFIG["packing"] and tokenizer.eos_token_id is None:
+            print("Tokenizer has no EOS token; packing would merge examples")
+            return
+        dataset = build_dataset(data_dir, tokenizer)
+        print(f"Training on {len(dataset)} rows")
+
+    # Pick the largest batch that fits in GPU memory
+    if use_cuda:
+        batch_size = find_batch_size(model, tokenizer)
+    else:
+        batch_size = CONFIG["batch_size_candidates"][-1]
+    print(f"Using batch size {batch_size}")
 
-    print(f"Training on {len(dataset)} examples")
+    # Compile after the batch-size probe so it doesn't recompile per candidate
+    torch_version = tuple(int(v) for v in torch.__version__.split(".")[:2])
+    if torch_version >= (2, 1) and use_cuda and not args.local:
+        print("Compiling model forward with torch.compile...")
+        model.config.use_cache = False  # KV cache conflicts with compiled graphs
+        _compile_forward(model)
 
     # Training arguments
     training_args = TrainingArguments(
         output_dir=CONFIG["output_dir"],
-        per_device_train_batch_size=CONFIG["batch_size"],
-        gradient_accumulation_steps=CONFIG["gradient_accumulation_steps"],
+        per_device_train_batch_size=batch_size,
+        gradient_accumulation_steps=max(1, CONFIG["effective_batch_size"] // batch_size),
         learning_rate=CONFIG["learning_rate"],
         num_train_epochs=CONFIG["num_epochs"],
-        warmup_steps=CONFIG["warmup_steps"],
-        max_steps=CONFIG["max_steps"],
-        fp16=not args.local,  # Use fp16 on GPU
-        bf16=args.local,  # Use bf16 on Apple Silicon
+        warmup_ratio=CONFIG["warmup_ratio"],
+        weight_decay=CONFIG["weight_decay"],
+        max_steps=max_steps,
+        # Packed rows have no padding to save; streams have no lengths to sort
+        group_by_length=not CONFIG["packing"] and not args.stream,
+        length_column_name="length",
+        **pick_precision(),
         logging_steps=10,
+        save_strategy="steps",
         save_steps=100,
-        save_total_limit=2,
-        optim="adamw_8bit",
+        save_total_limit=1,
+        save_safetensors=True,
+        optim="paged_adamw_8bit" if use_cuda else "adamw_torch",  # bitsandbytes needs CUDA
+        dataloader_num_workers=4 if args.stream else 0,
+        dataloader_pin_memory=use_cuda,
+        dataloader_prefetch_factor=4 if args.stream else None,
         seed=42,
     )
 
@@ -192,8 +570,15 @@ def fine_tune(args):
         model=model,
         tokenizer=tokenizer,
         train_dataset=dataset,
-        dataset_text_field="text",
+        # Both dataset paths are pre-tokenized; use them as-is
+        dataset_text_field=None,
+        dataset_kwargs={"skip_prepare_dataset": True},
         max_seq_length=CONFIG["max_seq_length"],
+        packing=False,  # build_dataset packs; SFTTrainer skips pre-tokenized data
+        # Pad to a multiple of 64 so flash attention stays on its fast tiles
+        data_collator=DataCollatorForLanguageModeling(
+            tokenizer, mlm=False, pad_to_multiple_of=64
+        ),
         args=training_args,
     )
 
@@ -202,16 +587,31 @@ def fine_tune(args):
     print("-" * 40)
     trainer.train()
 
-    # Save model
-    print("\nSaving fine-tuned model...")
-    model.save_pretrained(CONFIG["output_dir"])
+    # Save model (LoRA adapters only; base weights are unchanged)
+    print("\nSaving fine-tuned adapters...")
+    model.save_pretrained(
+        CONFIG["output_dir"],
+        save_embedding_layers=False,
+        safe_serialization=True,
+    )
     tokenizer.save_pretrained(CONFIG["output_dir"])
 
     print(f"\nModel saved to: {CONFIG['output_dir']}")
 
     # Export to GGUF if requested
-    if args.export_gguf:
-        export_gguf(model, tokenizer)
+    if args.export_gguf and not use_cuda:
+        print("GGUF export needs Unsloth (CUDA); run --merge-only --export-gguf on a GPU")
+    elif args.export_gguf:
+        llama_cpp_tools = _llama_cpp_tools()
+        if llama_cpp_tools:
+            # Free the GPU before llama.cpp does the heavy conversion
+            save_merged(model, tokenizer)
+            del trainer, model
+            gc.collect()
+            torch.cuda.empty_cache()
+            export_gguf_llama_cpp(CONFIG["merged_output_dir"], llama_cpp_tools)
+        else:
+            export_gguf(model, tokenizer)
 
     print("\n" + "=" * 60)
     print("Fine-tuning complete!")
@@ -234,6 +634,99 @@ def export_gguf(model, tokenizer):
         print("You can export manually with llama.cpp")
 
 
+def _llama_cpp_tools() -> tuple[Path, Path] | None:
+    """Return (convert_hf_to_gguf.py, llama-quantize) from $LLAMA_CPP_DIR.
+
+    Returns None if LLAMA_CPP_DIR is unset or either tool is missing, in
+    which case callers fall back to Unsloth's in-process export.
+    """
+    llama_cpp_dir = os.environ.get("LLAMA_CPP_DIR")
+    if not llama_cpp_dir:
+        return None
+
+    llama_cpp_dir = Path(llama_cpp_dir)
+    convert = llama_cpp_dir / "convert_hf_to_gguf.py"
+    quantize = next(
+        (p for p in (llama_cpp_dir / "llama-quantize",
+                     llama_cpp_dir / "build" / "bin" / "llama-quantize")
+         if p.exists()),
+        None,
+    )
+    if not convert.exists() or quantize is None:
+        print(f"convert_hf_to_gguf.py or llama-quantize not found in {llama_cpp_dir}; "
+              "falling back to in-process GGUF export")
+        return None
+    return convert, quantize
+
+
+def export_gguf_llama_cpp(merged_dir: str, tools: tuple[Path, Path]):
+    """Convert merged HF weights to GGUF and quantize with llama.cpp.
+
+    Runs llama.cpp's convert_hf_to_gguf.py to a bf16 master file, then the
+    native llama-quantize binary for q4_k_m, both as subprocesses. The bf16
+    file is removed once quantization succeeds.
+    """
+    convert, quantize = tools
+    bf16_output = CONFIG["gguf_output"].replace(".gguf", ".bf16.gguf")
+
+    print(f"\nConverting to GGUF with llama.cpp: {convert.parent}")
+    try:
+        subprocess.run(
+            [sys.executable, str(convert), merged_dir,
+             "--outtype", "bf16", "--outfile", bf16_output],
+            check=True,
+        )
+        subprocess.run(
+            [str(quantize), bf16_output, CONFIG["gguf_output"], "q4_k_m"],
+            check=True,
+        )
+        Path(bf16_output).unlink()  # Multi-GB intermediate, no longer needed
+        print(f"GGUF model saved to: {CONFIG['gguf_output']}")
+    except subprocess.CalledProcessError as e:
+        print(f"GGUF export failed: {e}")
+
+
+def save_merged(model, tokenizer):
+    """Save LoRA adapters merged into 16-bit base weights."""
+    # Fold B·A into each adapted linear so inference runs plain GEMMs
+    print("\nMerging LoRA adapters into base weights...")
+    model.save_pretrained_merged(
+        CONFIG["merged_output_dir"],
+        tokenizer,
+        save_method="merged_16bit",
+    )
+    print(f"Merged model saved to: {CONFIG['merged_output_dir']}")
+
+
+def merge_adapters(args):
+    """Merge saved LoRA adapters into the base weights without retraining."""
+    try:
+        import torch
+        from unsloth import FastLanguageModel
+    except ImportError:
+        print("Missing unsloth. Install with: pip install unsloth")
+        return
+
+    print(f"Loading adapters from: {CONFIG['output_dir']}")
+    model, tokenizer = FastLanguageModel.from_pretrained(
+        model_name=CONFIG["output_dir"],
+        max_seq_length=CONFIG["max_seq_length"],
+        load_in_4bit=CONFIG["load_in_4bit"],
+    )
+
+    save_merged(model, tokenizer)
+
+    if args.export_gguf:
+        llama_cpp_tools = _llama_cpp_tools()
+        if llama_cpp_tools:
+            del model
+            gc.collect()
+            torch.cuda.empty_cache()
+            export_gguf_llama_cpp(CONFIG["merged_output_dir"], llama_cpp_tools)
+        else:
+            export_gguf(model, tokenizer)
+
+
 # ═══════════════════════════════════════════════════════════════════
 # INFERENCE TEST
 # ═══════════════════════════════════════════════════════════════════
@@ -241,6 +734,7 @@ def export_gguf(model, tokenizer):
 def test_inference(args):
     """Test the fine-tuned model with sample prompts."""
     try:
+        import torch
         from unsloth import FastLanguageModel
     except ImportError:
         print("Missing unsloth. Install with: pip install unsloth")
@@ -265,41 +759,43 @@ def test_inference(args):
     print("INFERENCE TEST")
     print("=" * 60)
 
-    for prompt in test_prompts:
-        print(f"\nPrompt: {prompt}")
-        print("-" * 40)
-
-        formatted_prompt = f"""<|system|>
-{SYSTEM_PROMPT}
-<|end|>
-<|user|>
-{prompt}
-<|end|>
-<|assistant|>
-"""
+    # Generate all prompts in one greedy batch; left-pad so outputs line up
+    tokenizer.padding_side = "left"
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
 
-        inputs = tokenizer(formatted_prompt, return_tensors="pt").to(model.device)
+    formatted_prompts = [_PROMPT_PREFIX + prompt + _PROMPT_SUFFIX for prompt in test_prompts]
+    inputs = tokenizer(formatted_prompts, return_tensors="pt", padding=True).to(model.device)
+    with torch.inference_mode():
         outputs = model.generate(
             **inputs,
             max_new_tokens=512,
-            temperature=0.3,
-            do_sample=True,
+            num_beams=1,
+            do_sample=False,
+            use_cache=True,
             pad_token_id=tokenizer.eos_token_id,
         )
 
-        response = tokenizer.decode(outputs[0], skip_special_tokens=True)
-        # Extract just the assistant response
-        if "<|assistant|>" in response:
-            response = response.split("<|assistant|>")[-1].strip()
+    # Keep just the generated assistant response
+    responses = tokenizer.batch_decode(
+        outputs[:, inputs["input_ids"].shape[1]:],
+        skip_special_tokens=True,
+    )
 
+    loads = orjson.loads if orjson is not None else json.loads
+    for prompt, response in zip(test_prompts, responses):
+        print(f"\nPrompt: {prompt}")
+        print("-" * 40)
+
+        response = response.strip()
         print(f"Output: {response[:500]}...")
 
-        # Validate JSON
+        # Validate JSON (orjson.JSONDecodeError subclasses json.JSONDecodeError)
         try:
-            parsed = json.loads(response)
+            parsed = loads(response)
             print(f"✓ Valid JSON with {len(parsed.get('elements', []))} elements")
-        except json.JSONDecodeError:
-            print("✗ Invalid JSON output")
+        except json.JSONDecodeError as e:
+            print(f"✗ Invalid JSON output: {e}")
 
 
 # ═══════════════════════════════════════════════════════════════════
@@ -313,13 +809,18 @@ def main():
     parser.add_argument(
         "--local",
         action="store_true",
-        help="Run on local machine (uses bf16 for Apple Silicon)",
+        help="Run on local machine (skips torch.compile)",
     )
     parser.add_argument(
         "--export-gguf",
         action="store_true",
         help="Export to GGUF format for Ollama after training",
     )
+    parser.add_argument(
+        "--merge-only",
+        action="store_true",
+        help="Merge saved LoRA adapters into the base model without training",
+    )
     parser.add_argument(
         "--test",
         action="store_true",
@@ -330,11 +831,23 @@ def main():
         type=str,
         help="Path to training data directory",
     )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Stream training data instead of loading it into memory",
+    )
+    parser.add_argument(
+        "--max-steps",
+        type=int,
+        help="Number of training steps (required with --stream)",
+    )
 
     args = parser.parse_args()
 
     if args.test:
         test_inference(args)
+    elif args.merge_only:
+        merge_adapters(args)
     else:
         fine_tune(args)
 